@@ -1,24 +1,31 @@
 import argparse
-import base64
+import binascii
+import json
 
 import kubernetes.client.exceptions
+from concurrent.futures import Future, ThreadPoolExecutor
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.x509.oid import NameOID
 from dataclasses import dataclass
-from datetime import datetime, timezone, timedelta
-from kubernetes import client, config, utils
+from functools import cached_property
+from datetime import datetime, timezone
+from kubernetes import client, config, utils, watch
 import logging
 import os
-import time
 import yaml
 
+try:
+    from yaml import CSafeLoader as _YAML_LOADER, CSafeDumper as _YAML_DUMPER
+except ImportError:
+    from yaml import SafeLoader as _YAML_LOADER, SafeDumper as _YAML_DUMPER
+
 DEF_KUBECONFIG = os.getenv("KUBECONFIG", os.path.expanduser("~/.kube/config"))
 CLUSTER_USER = "qa-monitor"
-KUBECTL_CMD = "kubectl"
+KEY_ALGORITHMS = ("ed25519", "rsa")
+CSR_TIMEOUT = 300
 EPILOG = f"""Script to generate a monitor (readonly) kubeconfig from an existing
 kubeconfig that has full access.  This script will create a new role and
 rolebinding.  A default user name '{CLUSTER_USER}' is created and a certificate issued.
@@ -39,52 +46,111 @@ class ClusterRoleRule:
 DEFAULT_RULES = [
     ClusterRoleRule(groups=["*"], resources=["*"], verbs=["list", "get", "watch"])
 ]
+# Static part of the certificate subject, the user name is appended as the common name
+CSR_BASE_NAME_ATTRS = [
+    x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
+    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"NC"),
+    x509.NameAttribute(NameOID.LOCALITY_NAME, u"RTP"),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"NetApp"),
+]
 logger = logging.getLogger(os.path.basename(__file__))
 
 
+def get_temp_dir() -> (None, str):
+    """
+    Memory backed directory for the credential files the kubernetes client writes out, None
+    falls back to the system default temp directory
+    """
+    for temp_dir in (os.getenv("XDG_RUNTIME_DIR") or None, "/dev/shm"):
+        if temp_dir and os.path.isdir(temp_dir) and os.access(temp_dir, os.W_OK):
+            return temp_dir
+    return None
+
+
+def read_kubeconfig(path: str) -> dict:
+    """Parse a kubeconfig file, using the json parser when the content is json"""
+    with open(path, "r") as fh:
+        content = fh.read()
+    if content.lstrip().startswith("{"):
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            # A yaml flow mapping also starts with '{'
+            pass
+    return yaml.load(content, Loader=_YAML_LOADER)
+
+
+def resource_exists(read_method, name: str) -> bool:
+    """Check for a named resource with a direct read, treating 404 as not found"""
+    try:
+        read_method(name=name)
+    except kubernetes.client.exceptions.ApiException as k8s_exception:
+        if k8s_exception.status != 404:
+            raise
+        return False
+    return True
+
+
 class KubeConfig:
 
     def __init__(self, admin_config_path: str, monitor_user: str = CLUSTER_USER,
-                 existing_role: (None, str) = None, context: (None, str) = None):
+                 existing_role: (None, str) = None, context: (None, str) = None,
+                 key_algorithm: str = "ed25519", key_size: int = 2048):
 
         self.admin_config_path = admin_config_path
         self.monitor_user = monitor_user
         self.existing_role = existing_role
-
-        config.load_kube_config(config_file=admin_config_path, context=context)
-        self.k8s_client = client.ApiClient()
-
-        with open(admin_config_path, "r") as fh:
-            self.config_data = yaml.safe_load(fh)
+        self.key_algorithm = key_algorithm
+        self.key_size = key_size
+
+        # Parse the kubeconfig once and hand the result to the kubernetes loader rather than
+        # letting load_kube_config() parse the same file a second time
+        self.config_data = read_kubeconfig(admin_config_path)
+        loader = config.kube_config.KubeConfigLoader(
+            config_dict=config.kube_config.ConfigNode(admin_config_path, self.config_data, admin_config_path),
+            active_context=context,
+            config_base_path=None,
+            config_persister=self.save_config_data,
+            temp_file_path=get_temp_dir()
+        )
+        client_config = client.Configuration()
+        loader.load_and_set(client_config)
+        client.Configuration.set_default(client_config)
+        self.k8s_client = client.ApiClient(configuration=client_config)
 
         # Currently, multiple contexts are not supported
         if len(self.config_data['clusters']) > 1:
             raise RuntimeError(f"Config file {admin_config_path} contains multiple contexts")
         self.cluster_index = 0
 
-    @property
+    def save_config_data(self):
+        """Write credentials refreshed by the kubernetes loader (e.g. gcp/oidc tokens) back to the source kubeconfig"""
+        with open(self.admin_config_path, "w") as fh:
+            yaml.dump(self.config_data, fh, Dumper=_YAML_DUMPER, default_flow_style=False)
+
+    @cached_property
     def cluster_name(self) -> str:
         """cluster name is retrieved from source kubeconfig"""
         return self.config_data['clusters'][self.cluster_index]['name']
 
-    @property
+    @cached_property
     def cluster_server(self) -> str:
         """server is retrieved from source kubeconfig"""
         return self.config_data['clusters'][self.cluster_index]['cluster']['server']
 
-    @property
-    def k8s_ca(self) -> str:
-        """k8s ca is retrieved from source kubeconfig"""
-        return self.config_data['clusters'][self.cluster_index]['cluster']['certificate-authority-data']
+    @cached_property
+    def k8s_ca(self) -> (None, str):
+        """k8s ca is retrieved from source kubeconfig, None when the ca is referenced by file"""
+        return self.config_data['clusters'][self.cluster_index]['cluster'].get('certificate-authority-data')
 
-    @property
+    @cached_property
     def role_name(self) -> str:
         """role name is derived from user name unless provided"""
         if self.existing_role is None:
             return f"{self.monitor_user}-role"
         return self.existing_role
 
-    @property
+    @cached_property
     def role_binding_name(self) -> str:
         """
         role binding name is derived from both user and role which is redundant in some cases
@@ -92,39 +158,35 @@ class KubeConfig:
         """
         return f"{self.monitor_user}-{self.role_name}"
 
-    @property
+    @cached_property
     def cert_request_name(self) -> str:
         """cert request is based from user name"""
         return f"{self.monitor_user}-cr"
 
-    @property
-    def run_env(self) -> dict:
-        """run environement for kubectl commands"""
-        run_env = os.environ.copy()
-        run_env["KUBECONFIG"] = self.admin_config_path
-        return run_env
-
     def generate_csr(self) -> tuple[bytes, bytes]:
 
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=4096,
-            backend=default_backend()
-        )
+        if self.key_algorithm == "ed25519":
+            # Ed25519 signs with its built-in hash
+            private_key = ed25519.Ed25519PrivateKey.generate()
+            sign_hash = None
+        elif self.key_algorithm == "rsa":
+            private_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=self.key_size
+            )
+            sign_hash = hashes.SHA256()
+        else:
+            raise ValueError(f"Unsupported key algorithm '{self.key_algorithm}'")
         b = x509.CertificateSigningRequestBuilder()
-        req = b.subject_name(x509.Name([
-            x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
-            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"NC"),
-            x509.NameAttribute(NameOID.LOCALITY_NAME, u"RTP"),
-            x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"NetApp"),
-            x509.NameAttribute(NameOID.COMMON_NAME, self.monitor_user)
-        ])).sign(private_key, hashes.SHA256(), default_backend())
+        req = b.subject_name(x509.Name(
+            CSR_BASE_NAME_ATTRS + [x509.NameAttribute(NameOID.COMMON_NAME, self.monitor_user)]
+        )).sign(private_key, sign_hash)
 
         cert = req.public_bytes(encoding=serialization.Encoding.PEM)
 
         pem = private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            format=serialization.PrivateFormat.PKCS8,
             encryption_algorithm=serialization.NoEncryption()
         )
 
@@ -138,16 +200,17 @@ class KubeConfig:
 
     def approve_k8s_csr(self) -> bytes:
 
-        certs_api = client.CertificatesV1beta1Api()
+        certs_api = client.CertificatesV1Api(self.k8s_client)
 
         # Get the CSR
-        body = certs_api.read_certificate_signing_request_status(self.cert_request_name)
+        body = certs_api.read_certificate_signing_request_approval(self.cert_request_name)
 
         # create an approval condition
-        approval_condition = client.V1beta1CertificateSigningRequestCondition(
+        approval_condition = client.V1CertificateSigningRequestCondition(
             last_update_time=datetime.now(timezone.utc).astimezone(),
             message='This certificate was approved by Python Client API',
             reason='MyOwnReason',
+            status='True',
             type='Approved')
 
         # patch the existing `body` with the new conditions
@@ -160,30 +223,38 @@ class KubeConfig:
             body
         )
 
-        start_timer = datetime.now()
-        while response.status.certificate is None:
-            time.sleep(5)
-            if datetime.now() - start_timer > timedelta(seconds=300):
-                raise TimeoutError("Timeout waiting for certificate")
-            response = certs_api.read_certificate_signing_request_status(
-                name=self.cert_request_name
-            )
-
-        signed_cert = base64.b64decode(response.status.certificate)
+        # Wait for the signer to issue the certificate, waking on the update rather than polling
+        certificate = response.status.certificate
+        if certificate is None:
+            csr_watch = watch.Watch()
+            for event in csr_watch.stream(certs_api.list_certificate_signing_request,
+                                          field_selector=f"metadata.name={self.cert_request_name}",
+                                          timeout_seconds=CSR_TIMEOUT):
+                csr = event['object']
+                if csr.status and csr.status.certificate:
+                    certificate = csr.status.certificate
+                    csr_watch.stop()
+                    break
+        if certificate is None:
+            raise TimeoutError("Timeout waiting for certificate")
+
+        signed_cert = binascii.a2b_base64(certificate)
 
         return signed_cert
 
     def get_config_data(self, client_cert: bytes, client_key: bytes, config_id: str = ""):
         if config_id == "":
             config_id = self.cluster_name
-        with open(self.k8s_client.configuration.ssl_ca_cert, "rb") as fh:
-            ca_data = fh.read()
+        ca_data_b64 = self.k8s_ca
+        if ca_data_b64 is None:
+            with open(self.k8s_client.configuration.ssl_ca_cert, "rb") as fh:
+                ca_data_b64 = binascii.b2a_base64(fh.read(), newline=False).decode('ascii')
         cluster_config = {
             'apiVersion': 'v1',
             'clusters': [
                 {
                     'cluster': {
-                        'certificate-authority-data': base64.b64encode(ca_data).decode('utf-8'),
+                        'certificate-authority-data': ca_data_b64,
                         'server': self.k8s_client.configuration.host
                     },
                     'name': config_id
@@ -206,8 +277,8 @@ class KubeConfig:
                 {
                     'name': self.monitor_user,
                     'user': {
-                        'client-certificate-data': base64.b64encode(client_cert).decode('utf-8'),
-                        'client-key-data': base64.b64encode(client_key).decode('utf-8')
+                        'client-certificate-data': binascii.b2a_base64(client_cert, newline=False).decode('ascii'),
+                        'client-key-data': binascii.b2a_base64(client_key, newline=False).decode('ascii')
                     }
                 }
             ]
@@ -251,14 +322,15 @@ class KubeConfig:
         self.apply_dict_to_k8s(role_binding)
         return self.role_binding_name
 
-    def create_user_auth_cert(self) -> tuple[bytes, bytes]:
+    def create_user_auth_cert(self, pending_csr: (None, Future) = None) -> tuple[bytes, bytes]:
         """
         Create a certificate for k8s authentication
+        :param pending_csr: optional future resolving to the result of generate_csr()
         :return: tuple of user certificate and user private key
         """
 
         # Check for existing CSR
-        certs_api = client.CertificatesV1beta1Api()
+        certs_api = client.CertificatesV1Api(self.k8s_client)
         try:
             response = certs_api.read_certificate_signing_request_status(
                 name=self.cert_request_name
@@ -272,7 +344,10 @@ class KubeConfig:
                 certs_api.delete_certificate_signing_request(name=self.cert_request_name)
 
         logging.info(f"Generating cert request {self.cert_request_name}")
-        cr, pem = self.generate_csr()
+        if pending_csr is None:
+            cr, pem = self.generate_csr()
+        else:
+            cr, pem = pending_csr.result()
 
         # Apply the cert request to k8s
         cert_request = {
@@ -281,7 +356,7 @@ class KubeConfig:
             "metadata": {"name": self.cert_request_name},
             "spec": {
                 "signerName": "kubernetes.io/kube-apiserver-client",
-                "request": base64.b64encode(cr).decode('utf-8'),
+                "request": binascii.b2a_base64(cr, newline=False).decode('ascii'),
                 "usages": ["client auth"]
             }
         }
@@ -302,8 +377,7 @@ class KubeConfig:
         rbac_api = client.RbacAuthorizationV1Api(self.k8s_client)
 
         # Check if role/binding already exists
-        bindings = [b.metadata.name for b in rbac_api.list_cluster_role_binding().items]
-        if self.role_binding_name in bindings:
+        if resource_exists(rbac_api.read_cluster_role_binding, self.role_binding_name):
             ans = input(f"Cluster role binding '{self.role_binding_name}' already exists, overwrite? (y/N)")
             if ans not in ("y", "Y"):
                 logger.info("Terminating script by user")
@@ -311,15 +385,15 @@ class KubeConfig:
             logger.info(f"Deleting clusterrolebinding '{self.role_binding_name}'")
             rbac_api.delete_cluster_role_binding(name=self.role_binding_name)
 
-        roles = [r.metadata.name for r in rbac_api.list_cluster_role().items]
-        if self.role_name in roles and not self.existing_role:
+        role_exists = resource_exists(rbac_api.read_cluster_role, self.role_name)
+        if role_exists and not self.existing_role:
             ans = input(f"Cluster role '{self.role_name}' already exists, overwrite? (y/N)")
             if ans not in ("y", "Y"):
                 logger.info("Terminating script by user")
                 return
             logger.info(f"Deleting clusterrole '{self.role_name}'")
             rbac_api.delete_cluster_role(name=self.role_name)
-        elif self.existing_role and self.role_name not in roles:
+        elif self.existing_role and not role_exists:
             raise RuntimeError(f"Role {self.existing_role} specified but does not exist")
 
         # Create the monitor role/binding in k8s
@@ -350,6 +424,13 @@ def get_args():
         required=False,
         help=f"Existing K8s role to bind to user. Omit to create a role that uses default list/get/watch rules"
     )
+    parser.add_argument(
+        "--key-algorithm", "-a",
+        choices=KEY_ALGORITHMS,
+        default=KEY_ALGORITHMS[0],
+        help=f"Key algorithm for the user certificate, use rsa if the cluster CA rejects "
+             f"ed25519 default={KEY_ALGORITHMS[0]}"
+    )
     return parser.parse_args()
 
 
@@ -362,14 +443,19 @@ def main():
     kube_config = KubeConfig(
         admin_config_path=os.path.expanduser(args.kubeconfig),
         monitor_user=args.user,
-        existing_role=args.role
+        existing_role=args.role,
+        key_algorithm=args.key_algorithm
     )
 
-    # Create the cluster role and role binding
-    kube_config.create_monitor_user_role()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Generate the user key and csr in the background while the role and binding are created
+        pending_csr = executor.submit(kube_config.generate_csr)
+
+        # Create the cluster role and role binding
+        kube_config.create_monitor_user_role()
 
-    # Create the certificate for authentication
-    user_cert, user_key = kube_config.create_user_auth_cert()
+        # Create the certificate for authentication
+        user_cert, user_key = kube_config.create_user_auth_cert(pending_csr=pending_csr)
 
     # Log cert expiration
     cert_object = x509.load_pem_x509_certificate(user_cert)
@@ -378,7 +464,7 @@ def main():
     # Generate the kubeconfig data and write it to the file
     config_data = kube_config.get_config_data(client_cert=user_cert, client_key=user_key)
     with open(args.outfile, "w") as fh:
-        yaml.safe_dump(config_data, fh)
+        yaml.dump(config_data, fh, Dumper=_YAML_DUMPER)
 
 
 if __name__ == "__main__":